@@ -57,7 +57,9 @@ def populate():
 
 
 def add_page(cat, title, url, views=0):
-    p = Page.objects.get_or_create(category=cat, title=title, url=url, views=views)[0]
+    p = Page.objects.with_url(url).filter(category=cat).first()
+    if p is None:
+        p = Page.objects.create(category=cat, title=title, url=canonicalize(url), views=views)
     return p
 
 
@@ -70,5 +72,6 @@ if __name__ == '__main__':
     print "Starting Rango population script..."
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tango_with_django_project.settings')
     from rango.models import Category, Page
+    from rango.urlnorm import canonicalize
 
     populate()
\ No newline at end of file
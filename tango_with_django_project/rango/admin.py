@@ -1,12 +1,221 @@
-from django.contrib import admin
-from models import Category, Page, UserProfile
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.core.cache import cache
+from django.db import connection, DatabaseError
+from django.db.models import Count
+from django.db.models.query import QuerySet
+from django.template.response import TemplateResponse
+from django.utils.html import format_html
 
-admin.site.register(Category)
+from models import Category, Page, UserProfile, TOP_PAGES_CACHE_KEY
+from urlnorm import url_hash
 
 
-class PageAdmin(admin.ModelAdmin):
-    list_display = ('title', 'category', 'url')
+def estimated_count(model):
+    """The planner's row count for the model's table, or None if unknown."""
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'sqlite':
+            # Filled in by ANALYZE; the first number of each row is the row count.
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    except DatabaseError:
+        return None
+    if row is None:
+        return None
+    # reltuples is a float, and -1 on PostgreSQL 14+ for a table that has
+    # never been analyzed.
+    estimate = int(float(str(row[0]).split()[0]))
+    return estimate if estimate > 0 else None
 
 
+class EstimatedCountQuerySet(QuerySet):
+    """Answers unfiltered count() from table statistics on large tables.
+
+    The changelist counts the whole table for its paginator and its
+    "N total" link, which on a big table costs a full scan every page view.
+    """
+
+    def count(self):
+        if self._result_cache is None and not self.query.where:
+            estimate = estimated_count(self.model)
+            if estimate is not None and estimate >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+
+class EstimatedCountMixin(object):
+    def get_queryset(self, request):
+        qs = super(EstimatedCountMixin, self).get_queryset(request)
+        return EstimatedCountQuerySet(model=qs.model, query=qs.query, using=qs.db)
+
+
+class ExactFirstSearchMixin(object):
+    """Tries an exact match on exact_search_field before search_fields.
+
+    The prefix searches in search_fields compile to LIKE, which SQLite
+    cannot answer from an index, so they scan the table. An exact match can
+    use the field's index and is what an admin pasting a name usually wants.
+    """
+    exact_search_field = None
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term:
+            exact = queryset.filter(**{self.exact_search_field: term})
+            if exact.exists():
+                return exact, False
+        return super(ExactFirstSearchMixin, self).get_search_results(request, queryset, search_term)
+
+
+class CategoryAdmin(EstimatedCountMixin, ExactFirstSearchMixin, admin.ModelAdmin):
+    list_display = ('name', 'views', 'likes')
+    search_fields = ('^name',)
+    exact_search_field = 'name'
+
+
+class CategoryIdFilter(admin.SimpleListFilter):
+    """Filters pages by category id, e.g. ?category=3.
+
+    Listing every category would load the whole table into the sidebar, so
+    only the selected one is shown; follow the links in the category column
+    to filter.
+    """
+    title = 'category'
+    parameter_name = 'category'
+
+    def lookups(self, request, model_admin):
+        # Called before self.value() is set.
+        value = request.GET.get(self.parameter_name)
+        if value is None:
+            return []
+        category = Category.objects.filter(id=value).first() if value.isdigit() else None
+        return [(value, unicode(category) if category else value)]
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        try:
+            return queryset.filter(category=int(self.value()))
+        except ValueError:
+            raise IncorrectLookupParameters(self.value())
+
+
+class RecategorizeForm(forms.Form):
+    category = forms.ModelChoiceField(queryset=Category.objects.all())
+
+    def __init__(self, admin_site, pages, *args, **kwargs):
+        super(RecategorizeForm, self).__init__(*args, **kwargs)
+        self.pages = pages
+        # A raw id input with a lookup popup rather than a select listing
+        # every category.
+        self.fields['category'].widget = ForeignKeyRawIdWidget(Page._meta.get_field('category').rel, admin_site)
+
+    def clean_category(self):
+        # Moving must not create the duplicates dedupe_pages merges away.
+        category = self.cleaned_data['category']
+        moved = self.pages.exclude(category=category)
+        if moved.filter(url_hash__in=Page.objects.filter(category=category).values('url_hash')).exists() or \
+                moved.values('url_hash').annotate(copies=Count('id')).filter(copies__gt=1).exists():
+            raise forms.ValidationError(u'Some of these pages would duplicate a URL in "{0}". '
+                                        u'Merge them first.'.format(category))
+        return category
+
+
+class PageAdmin(EstimatedCountMixin, ExactFirstSearchMixin, admin.ModelAdmin):
+    list_display = ('title', 'category_link', 'url', 'views')
+    list_select_related = ('category',)
+    list_filter = (CategoryIdFilter,)
+    raw_id_fields = ('category',)
+    search_fields = ('^title',)
+    exact_search_field = 'title'
+    actions = ['merge_pages', 'recategorize', 'reset_views']
+    # Pages listed on the recategorize confirmation page.
+    recategorize_sample = 20
+
+    def category_link(self, page):
+        return format_html(u'<a href="?{0}={1}">{2}</a>', CategoryIdFilter.parameter_name, page.category_id,
+                           page.category)
+    category_link.short_description = 'category'
+    category_link.admin_order_field = 'category'
+
+    def get_search_results(self, request, queryset, search_term):
+        # Anything that could be a URL is looked up only through the indexed
+        # canonical URL hash.
+        term = search_term.strip()
+        if term and ' ' not in term and ('/' in term or '.' in term):
+            return queryset.filter(url_hash=url_hash(term)), False
+        return super(PageAdmin, self).get_search_results(request, queryset, search_term)
+
+    def merge_pages(self, request, queryset):
+        # Like dedupe_pages, only copies of one canonical URL in one category
+        # may be merged; anything else is almost certainly a mis-selection
+        # and cannot be undone. The hashes are worked out afresh, as copies
+        # that the unique constraint let in only differ by a stale hash.
+        copies = set()
+        for category_id, url in queryset.values_list('category', 'url').iterator():
+            copies.add((category_id, url_hash(url)))
+            if len(copies) > 1:
+                self.message_user(request, 'Only pages with the same URL in the same category can be merged. '
+                                           'Nothing was changed.', level=messages.ERROR)
+                return
+        page = Page.objects.merge(queryset)
+        cache.delete(TOP_PAGES_CACHE_KEY)
+        self.message_user(request, u'Merged the selected pages into "{0}".'.format(page))
+    merge_pages.short_description = 'Merge selected copies of a page'
+
+    def recategorize(self, request, queryset):
+        if 'apply' in request.POST:
+            form = RecategorizeForm(self.admin_site, queryset, request.POST)
+            if form.is_valid():
+                updated = queryset.update(category=form.cleaned_data['category'])
+                cache.delete(TOP_PAGES_CACHE_KEY)
+                self.message_user(request, u'Moved {0} pages to "{1}".'.format(
+                    updated, form.cleaned_data['category']))
+                return None
+        else:
+            form = RecategorizeForm(self.admin_site, queryset)
+
+        # With "select all" the queryset can be the whole table, so only a
+        # sample is listed. The form carries select_across and the ids ticked
+        # on the changelist page, which Django needs before it runs the
+        # action, rather than one id per page in the queryset.
+        return TemplateResponse(request, 'admin/rango/page/recategorize.html', {
+            'title': 'Move pages to another category',
+            'form': form,
+            'media': self.media + form.media,
+            'count': queryset.count(),
+            'sample': queryset.select_related('category')[:self.recategorize_sample],
+            'select_across': request.POST.get('select_across') == '1',
+            'selected': request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+            'opts': self.model._meta,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }, current_app=self.admin_site.name)
+    recategorize.short_description = 'Move selected pages to another category'
+
+    def reset_views(self, request, queryset):
+        updated = queryset.update(views=0)
+        cache.delete(TOP_PAGES_CACHE_KEY)
+        self.message_user(request, 'Reset the views of {0} pages.'.format(updated))
+    reset_views.short_description = 'Reset views of selected pages'
+
+
+class UserProfileAdmin(admin.ModelAdmin):
+    list_display = ('user', 'website')
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    search_fields = ('^user__username',)
+
+
+admin.site.register(Category, CategoryAdmin)
 admin.site.register(Page, PageAdmin)
-admin.site.register(UserProfile)
+admin.site.register(UserProfile, UserProfileAdmin)
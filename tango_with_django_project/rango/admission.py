@@ -0,0 +1,304 @@
+"""
+Admission control for the views that write to the database.
+
+SQLite lets one connection write at a time, so a burst of writes turns
+into requests waiting on its lock until they fail with "database is
+locked". AdmissionControlMiddleware keeps the burst in front of the
+database instead:
+
+* Token buckets limit each client and each route to a steady rate.
+* At most MAX_WRITERS write requests run at once. Others wait up to
+  MAX_WAIT seconds in a queue of at most MAX_QUEUE requests.
+* A request that is not admitted gets a 503 with Retry-After. On routes
+  configured to 'defer' it runs anyway with request.defer_writes set, and
+  the view hands its counter update to the task queue, unless it was the
+  client that went over its limit, which no route lets through.
+
+The state lives in a memory mapped file next to
+ADMISSION_CONTROL['STATE_PATH'] shared by every worker process on the host
+and guarded by flock().
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# Cumulative counters, followed by the peak queue depth.
+METRICS = ('admitted', 'shed', 'deferred', 'waited', 'wait_total', 'wait_max', 'peak_queue')
+HEADER = struct.Struct('<qqqqddq')
+# A writer or waiter: owning pid (0 when free) and when it was taken.
+ENTRY = struct.Struct('<qd')
+# A token bucket: key hash (0 when free), tokens left and last refill time.
+BUCKET = struct.Struct('<Qdd')
+BUCKET_STATE = struct.Struct('<dd')
+PROBES = 8
+
+
+def _config():
+    return settings.ADMISSION_CONTROL
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # EPERM means the process exists but belongs to another user.
+        return e.errno != errno.ESRCH
+    return True
+
+
+class SharedState(object):
+    """Token buckets, writer slots, waiter slots and metrics in one mmap."""
+
+    def __init__(self, path, max_writers, max_queue, buckets, max_hold):
+        self.max_writers = max_writers
+        self.max_queue = max_queue
+        self.buckets = buckets
+        self.max_hold = max_hold
+        self.writers_offset = HEADER.size
+        self.waiters_offset = self.writers_offset + max_writers * ENTRY.size
+        self.buckets_offset = self.waiters_offset + max_queue * ENTRY.size
+        self.size = self.buckets_offset + buckets * BUCKET.size
+        # Processes still mapping a file must never see it shrink under them,
+        # so each layout gets a file of its own.
+        layout = (HEADER.format, ENTRY.format, BUCKET.format, max_writers, max_queue, buckets)
+        self.path = '{0}.{1}'.format(path, hashlib.md5(repr(layout)).hexdigest()[:8])
+        self.pid = None
+        # flock() does not exclude threads sharing the file, so the threads
+        # of one process also take this lock.
+        self.thread_lock = threading.Lock()
+
+    def _open(self):
+        # flock() locks belong to the open file, which a forked child would
+        # share with its parent, so every process opens its own.
+        if self.pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        if os.fstat(fd).st_size < self.size:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < self.size:
+                # A new file, which starts out zeroed.
+                os.ftruncate(fd, self.size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.fd = fd
+        self.map = mmap.mmap(fd, self.size)
+        self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            self._open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # The methods below expect the lock to be held.
+
+    def _read_metrics(self):
+        return dict(zip(METRICS, HEADER.unpack_from(self.map, 0)))
+
+    def _write_metrics(self, metrics):
+        HEADER.pack_into(self.map, 0, *[metrics[name] for name in METRICS])
+
+    def _count(self, name, amount=1):
+        metrics = self._read_metrics()
+        metrics[name] += amount
+        self._write_metrics(metrics)
+
+    def _claim(self, offset, count, now):
+        """Take a free entry and return (index, now), or None if all are taken.
+
+        Entries left behind by a dead process, or by a thread of a live one
+        that never released them, are reclaimed once held for max_hold
+        seconds.
+        """
+        for index in range(count):
+            pid, since = ENTRY.unpack_from(self.map, offset + index * ENTRY.size)
+            if pid == 0 or now - since > self.max_hold or not _pid_alive(pid):
+                ENTRY.pack_into(self.map, offset + index * ENTRY.size, os.getpid(), now)
+                return index, now
+        return None
+
+    def _release(self, offset, entry):
+        index, since = entry
+        # A reclaimed entry belongs to someone else now.
+        if ENTRY.unpack_from(self.map, offset + index * ENTRY.size) == (os.getpid(), since):
+            ENTRY.pack_into(self.map, offset + index * ENTRY.size, 0, 0.0)
+
+    def _in_use(self, offset, count):
+        return sum(1 for index in range(count) if ENTRY.unpack_from(self.map, offset + index * ENTRY.size)[0])
+
+    def _bucket(self, key, now):
+        """Find or create the bucket for key; returns (offset, tokens, last)."""
+        digest = struct.unpack('<Q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0] or 1
+        oldest = None
+        for probe in range(PROBES):
+            offset = self.buckets_offset + ((digest + probe) % self.buckets) * BUCKET.size
+            slot_key, tokens, last = BUCKET.unpack_from(self.map, offset)
+            if slot_key == digest:
+                return offset, tokens, last
+            if slot_key == 0:
+                oldest = (offset, 0.0)
+                break
+            if oldest is None or last < oldest[1]:
+                oldest = (offset, last)
+        # A new bucket, possibly replacing the least recently used one.
+        BUCKET.pack_into(self.map, oldest[0], digest, float('inf'), now)
+        return oldest[0], float('inf'), now
+
+    def take_tokens(self, limits, now):
+        """Take a token from each (key, rate, burst) bucket, or none at all.
+
+        Returns 0 when admitted, otherwise the seconds until a retry could be.
+        """
+        with self.locked():
+            buckets = []
+            retry_after = 0
+            for key, rate, burst in limits:
+                offset, tokens, last = self._bucket(key, now)
+                tokens = min(burst, tokens + (now - last) * rate)
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                buckets.append((offset, tokens))
+
+            if not retry_after:
+                for (offset, tokens), (key, rate, burst) in zip(buckets, limits):
+                    BUCKET_STATE.pack_into(self.map, offset + 8, tokens - 1, now)
+            return retry_after
+
+    def acquire_writer(self, max_wait, poll_interval):
+        """Wait up to max_wait seconds for a writer slot; returns it or None."""
+        start = time.time()
+        with self.locked():
+            writer = self._claim(self.writers_offset, self.max_writers, start)
+            if writer is not None:
+                self._count('admitted')
+                return writer
+            waiter = self._claim(self.waiters_offset, self.max_queue, start)
+            if waiter is None:
+                return None
+            metrics = self._read_metrics()
+            metrics['peak_queue'] = max(metrics['peak_queue'], self._in_use(self.waiters_offset, self.max_queue))
+            self._write_metrics(metrics)
+
+        writer = None
+        try:
+            while writer is None and time.time() - start < max_wait:
+                time.sleep(poll_interval)
+                with self.locked():
+                    writer = self._claim(self.writers_offset, self.max_writers, time.time())
+        finally:
+            waited = time.time() - start
+            with self.locked():
+                self._release(self.waiters_offset, waiter)
+                metrics = self._read_metrics()
+                metrics['waited'] += 1
+                metrics['wait_total'] += waited
+                metrics['wait_max'] = max(metrics['wait_max'], waited)
+                if writer is not None:
+                    metrics['admitted'] += 1
+                self._write_metrics(metrics)
+        return writer
+
+    def release_writer(self, writer):
+        with self.locked():
+            self._release(self.writers_offset, writer)
+
+    def count(self, name):
+        with self.locked():
+            self._count(name)
+
+    def metrics(self):
+        with self.locked():
+            metrics = self._read_metrics()
+            metrics['writers'] = self._in_use(self.writers_offset, self.max_writers)
+            metrics['queue_depth'] = self._in_use(self.waiters_offset, self.max_queue)
+        metrics['wait_average'] = metrics['wait_total'] / metrics['waited'] if metrics['waited'] else 0.0
+        return metrics
+
+
+_state = None
+
+
+def get_state():
+    global _state
+    if _state is None:
+        config = _config()
+        _state = SharedState(config['STATE_PATH'], config['MAX_WRITERS'], config['MAX_QUEUE'], config['BUCKETS'],
+                             config['MAX_HOLD'])
+    return _state
+
+
+class AdmissionControlMiddleware(object):
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        config = _config()
+        match = getattr(request, 'resolver_match', None)
+        rule = config['ROUTES'].get(match.url_name) if match else None
+        if rule is None or request.method not in rule[1]:
+            return None
+        mode = rule[0]
+
+        if request.user.is_authenticated():
+            client = 'user:{0}'.format(request.user.pk)
+        else:
+            client = 'addr:{0}'.format(request.META.get('REMOTE_ADDR', ''))
+
+        state = get_state()
+        now = time.time()
+        # The client's limit is a hard one; deferring would let a single
+        # client flood the task queue instead of the database.
+        retry_after = state.take_tokens([('client:' + client, config['CLIENT_RATE'], config['CLIENT_BURST'])], now)
+        if retry_after:
+            return self.reject(request, state, 'shed', retry_after)
+
+        retry_after = state.take_tokens([('route:' + match.url_name, config['ROUTE_RATE'], config['ROUTE_BURST'])], now)
+        if retry_after:
+            return self.reject(request, state, mode, retry_after)
+
+        writer = state.acquire_writer(config['MAX_WAIT'], config['POLL_INTERVAL'])
+        if writer is None:
+            return self.reject(request, state, mode, config['MAX_WAIT'])
+        request._admission_writer = writer
+        return None
+
+    def reject(self, request, state, mode, retry_after):
+        if mode == 'defer':
+            state.count('deferred')
+            request.defer_writes = True
+            return None
+
+        state.count('shed')
+        response = HttpResponse("Rango is busy, please try again shortly.", status=503)
+        response['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+    def release(self, request):
+        writer = getattr(request, '_admission_writer', None)
+        if writer is not None:
+            get_state().release_writer(writer)
+            request._admission_writer = None
+
+    def process_response(self, request, response):
+        self.release(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self.release(request)
+        return None
+
+
+def metrics_json():
+    return json.dumps(get_state().metrics(), sort_keys=True)
@@ -2,6 +2,7 @@ from django import forms
 from django.contrib.auth.models import User
 
 from models import Page, Category, UserProfile
+from urlnorm import canonicalize
 
 
 class CategoryForm(forms.ModelForm):
@@ -34,9 +35,8 @@ class PageForm(forms.ModelForm):
         cleaned_data = self.cleaned_data
         url = cleaned_data.get('url')
 
-        if url and not url.startswith('http://'):
-            url = 'htpp://' + url
-            cleaned_data['url'] = url
+        if url:
+            cleaned_data['url'] = canonicalize(url)
 
         return cleaned_data
 
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from rango.retention import archive_actions
+
+
+class Command(BaseCommand):
+    help = 'Moves actions past their retention period (ACTION_RETENTION_DAYS) into compressed archive files.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=500, dest='chunk_size',
+                    help='Number of actions to move per transaction.'),
+        make_option('--pause', type='float', default=0.1,
+                    help='Seconds to sleep between chunks.'),
+        make_option('--dry-run', action='store_true', default=False, dest='dry_run',
+                    help='Only count the actions that would be archived.'),
+    )
+
+    def handle(self, *args, **options):
+        archived = archive_actions(chunk_size=options['chunk_size'], pause=options['pause'],
+                                   dry_run=options['dry_run'])
+        for verb, count in sorted(archived.items()):
+            self.stdout.write('{0}: {1} actions'.format(verb, count))
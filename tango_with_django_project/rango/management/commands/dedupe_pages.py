@@ -0,0 +1,71 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from rango.models import Page
+from rango.urlnorm import url_hash
+
+
+class Command(BaseCommand):
+    help = 'Backfills Page.url_hash and merges pages with the same canonical URL in a category.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=1000, dest='chunk_size',
+                    help='Number of pages to hash per transaction.'),
+        make_option('--dry-run', action='store_true', default=False, dest='dry_run',
+                    help='Report duplicates without merging them.'),
+    )
+
+    def handle(self, *args, **options):
+        updated, merged = self.backfill(options['chunk_size'], options['dry_run'])
+        self.stdout.write('Updated {0} URL hashes.'.format(updated))
+
+        # Databases from before the unique (category, url_hash) constraint
+        # can also hold copies that share a hash.
+        duplicates = (Page.objects.values('category', 'url_hash')
+                      .annotate(copies=Count('id'))
+                      .filter(copies__gt=1))
+        for group in duplicates:
+            if options['dry_run']:
+                self.stdout.write('Category {category}: {copies} copies of {url_hash}'.format(**group))
+            else:
+                merged += self.merge(group)
+        self.stdout.write('Merged {0} duplicate pages.'.format(merged))
+
+    def backfill(self, chunk_size, dry_run=False):
+        updated = merged = 0
+        last_id = 0
+        while True:
+            chunk = list(Page.objects.filter(id__gt=last_id).order_by('id')
+                         .values_list('id', 'category', 'url', 'url_hash')[:chunk_size])
+            if not chunk:
+                return updated, merged
+            with transaction.atomic():
+                for page_id, category_id, url, old_hash in chunk:
+                    new_hash = url_hash(url)
+                    if new_hash == old_hash:
+                        continue
+                    # A page whose new hash is already taken in its category
+                    # is a copy; the unique constraint means it is merged
+                    # rather than given the hash.
+                    copies = list(Page.objects.filter(category=category_id, url_hash=new_hash)
+                                  .values_list('id', flat=True))
+                    if not copies:
+                        Page.objects.filter(id=page_id).update(url_hash=new_hash)
+                        updated += 1
+                    elif dry_run:
+                        self.stdout.write('Category {0}: page {1} is a copy of {2}'.format(
+                            category_id, page_id, new_hash))
+                    else:
+                        Page.objects.merge(Page.objects.filter(id__in=copies + [page_id]))
+                        merged += len(copies)
+            last_id = chunk[-1][0]
+
+    @transaction.atomic
+    def merge(self, group):
+        pages = Page.objects.filter(category=group['category'], url_hash=group['url_hash'])
+        duplicates = pages.count() - 1
+        Page.objects.merge(pages)
+        return duplicates
@@ -0,0 +1,19 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from rango.retention import maintain_database
+
+
+class Command(BaseCommand):
+    help = 'Runs ANALYZE and releases free database pages.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', default=False,
+                    help='Run a full VACUUM. This locks the database until it finishes.'),
+    )
+
+    def handle(self, *args, **options):
+        report = maintain_database(full=options['full'])
+        for key, value in sorted(report.items()):
+            self.stdout.write('{0}: {1}'.format(key, value))
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tango_with_django_project.warmup import profile_imports
+
+
+class Command(BaseCommand):
+    help = 'Reports the slowest imports and warm start steps of a freshly started worker.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=25,
+                    help='Number of modules to list.'),
+    )
+
+    def handle(self, *args, **options):
+        report = profile_imports()
+
+        self.stdout.write('Loading the project took {0:.0f} ms.'.format(report['import_time'] * 1000))
+        self.stdout.write('')
+        self.stdout.write('{0:>10} {1:>10}  {2}'.format('total ms', 'self ms', 'module'))
+        imports = sorted(report['imports'].items(), key=lambda item: item[1][0], reverse=True)
+        for name, (cumulative, own) in imports[:options['limit']]:
+            self.stdout.write('{0:10.1f} {1:10.1f}  {2}'.format(cumulative * 1000, own * 1000, name))
+
+        self.stdout.write('')
+        self.stdout.write('Warm start:')
+        for step, seconds in report['warm_up']:
+            self.stdout.write('{0:10.1f}  {1}'.format(seconds * 1000, step))
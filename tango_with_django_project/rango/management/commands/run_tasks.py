@@ -0,0 +1,81 @@
+import multiprocessing
+import signal
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from rango import task_queue
+from rango.tasks import schedule_maintenance
+
+
+def _worker(lanes, burst, poll_interval, stop_event):
+    # Children are stopped through the shared event, not by SIGINT.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    task_queue.work(lanes, burst=burst, poll_interval=poll_interval, should_stop=stop_event.is_set)
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background tasks in one or more worker processes.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=1,
+                    help='Number of worker processes to run.'),
+        make_option('--lanes', default='high,default,low',
+                    help='Comma separated priority lanes to take jobs from.'),
+        make_option('--poll-interval', type='float', default=1.0, dest='poll_interval',
+                    help='Seconds to wait when the queue is empty.'),
+        make_option('--burst', action='store_true', default=False,
+                    help='Exit once the queue has been drained.'),
+        make_option('--purge', type='int', default=None,
+                    help='Delete done and failed jobs older than this many seconds and exit.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['purge'] is not None:
+            deleted = task_queue.purge(options['purge'])
+            self.stdout.write('Purged {0} done and failed jobs.'.format(deleted))
+            return
+
+        try:
+            lanes = [task_queue.LANES[lane.strip()] for lane in options['lanes'].split(',')]
+        except KeyError, e:
+            raise CommandError('Unknown lane {0}, expected one of {1}.'.format(e, ', '.join(task_queue.LANES)))
+
+        # Create the queue before forking and make sure the children do not
+        # share the parent's database connection.
+        task_queue.get_connection().close()
+        schedule_maintenance()
+        connection.close()
+
+        stop_event = multiprocessing.Event()
+        worker_args = (lanes, options['burst'], options['poll_interval'], stop_event)
+
+        def stop(signum, frame):
+            stop_event.set()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        workers = [self._start(worker_args) for i in range(options['workers'])]
+        self.stdout.write('Started {0} task workers on lanes {1}.'.format(len(workers), options['lanes']))
+
+        while workers:
+            time.sleep(0.5)
+            for i, worker in enumerate(workers):
+                if worker.is_alive():
+                    continue
+                if stop_event.is_set() or options['burst']:
+                    workers[i] = None
+                else:
+                    # A worker that died unexpectedly is replaced.
+                    self.stderr.write('Task worker {0} exited with {1}, restarting.'.format(
+                        worker.pid, worker.exitcode))
+                    workers[i] = self._start(worker_args)
+            workers = [worker for worker in workers if worker is not None]
+
+    def _start(self, worker_args):
+        worker = multiprocessing.Process(target=_worker, args=worker_args)
+        worker.start()
+        return worker
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from rango.recommendations import update_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Folds the clicks of finished days into the co-click counts and refreshes related pages.'
+
+    def handle(self, *args, **options):
+        changed = update_recommendations()
+        self.stdout.write('Updated related pages around {0} clicked pages.'.format(changed))
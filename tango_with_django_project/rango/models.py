@@ -1,5 +1,10 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from urlnorm import url_hash
 
 
 class Category(models.Model):
@@ -12,16 +17,138 @@ class Category(models.Model):
         return self.name
 
 
+class PageManager(models.Manager):
+    def with_url(self, url):
+        """Pages anywhere on the site whose URL canonicalizes the same as url."""
+        return self.filter(url_hash=url_hash(url))
+
+    @transaction.atomic
+    def merge(self, pages):
+        """Fold the given pages into the oldest one and return it.
+
+        Views are summed and activity stream actions and unfolded clicks
+        about the other pages are pointed at the survivor, all with set-based
+        queries in one transaction. Their co-click counts are added to the
+        survivor's, which overcounts sessions that visited more than two of
+        the pages, and other pages' recommendations of them now recommend
+        the survivor.
+        """
+        from actstream.models import Action
+        from django.contrib.contenttypes.models import ContentType
+
+        pages = pages.order_by('id')
+        keep = pages[0]
+        stale_ids = [str(page_id) for page_id in pages.exclude(id=keep.id).values_list('id', flat=True)]
+        if not stale_ids:
+            return keep
+
+        page_type = ContentType.objects.get_for_model(self.model)
+        Action.objects.filter(action_object_content_type=page_type, action_object_object_id__in=stale_ids) \
+            .update(action_object_object_id=str(keep.id))
+        Action.objects.filter(target_content_type=page_type, target_object_id__in=stale_ids) \
+            .update(target_object_id=str(keep.id))
+
+        Click.objects.filter(page__in=stale_ids).update(page=keep)
+
+        # A pair of copies becomes the survivor's own count, in which the
+        # sessions that visited both would otherwise be counted twice.
+        merged = set(int(page_id) for page_id in stale_ids) | set([keep.id])
+        counts = {}
+        stale_co_clicks = CoClick.objects.filter(models.Q(page_a__in=stale_ids) | models.Q(page_b__in=stale_ids))
+        for page_a, page_b, sessions in stale_co_clicks.values_list('page_a', 'page_b', 'sessions'):
+            if page_a != page_b and page_a in merged and page_b in merged:
+                sessions = -sessions
+            key = tuple(sorted(keep.id if page_id in merged else page_id for page_id in (page_a, page_b)))
+            counts[key] = counts.get(key, 0) + sessions
+        stale_co_clicks.delete()
+        CoClick.objects.add_sessions(counts)
+
+        # Each page keeps its best scored recommendation of any of the copies.
+        recommending = set(RelatedPage.objects.filter(related=keep).values_list('page', flat=True))
+        repointed = []
+        for related_id, page_id in RelatedPage.objects.filter(related__in=stale_ids).exclude(page__in=merged) \
+                .values_list('id', 'page'):
+            if page_id not in recommending:
+                recommending.add(page_id)
+                repointed.append(related_id)
+        for start in range(0, len(repointed), 500):
+            RelatedPage.objects.filter(id__in=repointed[start:start + 500]).update(related=keep)
+
+        keep.views = pages.aggregate(total=models.Sum('views'))['total']
+        self.filter(id=keep.id).update(views=keep.views)
+        self.filter(id__in=stale_ids).delete()
+        # Copies that only match since a URL rule changed can hold stale
+        # hashes, so the survivor's is refreshed once the others are gone.
+        keep.url_hash = url_hash(keep.url)
+        self.filter(id=keep.id).update(url_hash=keep.url_hash)
+        return keep
+
+
 class Page(models.Model):
     category = models.ForeignKey(Category)
-    title = models.CharField(max_length=128)
+    title = models.CharField(max_length=128, db_index=True)
     url = models.URLField()
+    # SHA-1 of urlnorm.url_key(url), kept up to date by save().
+    url_hash = models.CharField(max_length=40, db_index=True, editable=False)
     views = models.IntegerField(default=0)
 
+    objects = PageManager()
+
+    class Meta:
+        # One copy of a URL per category; run dedupe_pages before migrating.
+        unique_together = [('category', 'url_hash')]
+
+    def save(self, *args, **kwargs):
+        self.url_hash = url_hash(self.url)
+        super(Page, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return self.title
 
 
+class Click(models.Model):
+    """A page followed through track_url, kept until the recommender folds it in."""
+    # SHA-1 of the session key.
+    session = models.CharField(max_length=40)
+    page = models.ForeignKey(Page, related_name='+')
+    timestamp = models.DateTimeField(db_index=True)
+
+
+class CoClickManager(models.Manager):
+    def add_sessions(self, counts):
+        """Add {(page_a, page_b): sessions} to the counts, creating missing rows."""
+        created = []
+        for (page_a, page_b), sessions in counts.items():
+            if not self.filter(page_a=page_a, page_b=page_b).update(sessions=models.F('sessions') + sessions):
+                created.append(self.model(page_a_id=page_a, page_b_id=page_b, sessions=sessions))
+        self.bulk_create(created, batch_size=500)
+
+
+class CoClick(models.Model):
+    """Number of sessions that visited both pages, with page_a <= page_b.
+
+    Rows with page_a == page_b count the sessions that visited the page.
+    """
+    page_a = models.ForeignKey(Page, related_name='+')
+    page_b = models.ForeignKey(Page, related_name='+')
+    sessions = models.IntegerField(default=0)
+
+    objects = CoClickManager()
+
+    class Meta:
+        unique_together = [('page_a', 'page_b')]
+
+
+class RelatedPage(models.Model):
+    """The precomputed "people also visited" pages for a page."""
+    page = models.ForeignKey(Page, related_name='related_pages')
+    related = models.ForeignKey(Page, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['-score']
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User)
 
@@ -29,4 +156,21 @@ class UserProfile(models.Model):
     picture = models.ImageField(upload_to='profile_images', blank=True)
 
     def __unicode__(self):
-        return self.user.username
\ No newline at end of file
+        return self.user.username
+
+
+# Cache keys for the sidebar category list and the "Top Five Pages" leaderboard.
+CATEGORY_LIST_CACHE_KEY = 'rango:category_list'
+TOP_PAGES_CACHE_KEY = 'rango:top_pages'
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_caches(sender, **kwargs):
+    cache.delete_many([CATEGORY_LIST_CACHE_KEY, TOP_PAGES_CACHE_KEY])
+
+
+@receiver(post_delete, sender=Page)
+def invalidate_page_caches(sender, **kwargs):
+    # Saves only change view counts, which the leaderboard's timeout covers.
+    cache.delete(TOP_PAGES_CACHE_KEY)
@@ -0,0 +1,177 @@
+"""
+"People also visited" recommendations from co-clicks.
+
+Clicks logged by track_url are grouped into baskets: the pages one session
+visited on one day. update_recommendations() runs nightly. It folds the
+clicks of finished days into the CoClick counts, i.e. the page-page
+co-occurrence matrix C = X'X of the basket-page incidence matrix X, and
+then deletes them. For every page whose counts changed, and its neighbours,
+it rewrites the top related pages in RelatedPage, scored by cosine similarity
+C[a, b] / sqrt(C[a, a] * C[b, b]). Only the rows of C around those pages are
+read. Pages only ever read RelatedPage.
+
+NumPy and SciPy are only needed by this nightly job, which runs on the task
+workers, not by the web processes.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from models import Click, CoClick, RelatedPage
+
+# Stay under SQLite's limit on query parameters.
+CHUNK_SIZE = 500
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def basket_matrix(clicks):
+    """Build the binary basket x page matrix for (session, page_id, timestamp) rows.
+
+    Returns the CSR matrix and the page id of each column.
+    """
+    baskets = {}
+    rows = np.empty(len(clicks), dtype=np.int64)
+    page_ids = np.empty(len(clicks), dtype=np.int64)
+    for i, (session, page_id, timestamp) in enumerate(clicks):
+        rows[i] = baskets.setdefault((session, timestamp.date()), len(baskets))
+        page_ids[i] = page_id
+
+    pages, columns = np.unique(page_ids, return_inverse=True)
+    matrix = sparse.coo_matrix((np.ones(len(clicks)), (rows, columns)), shape=(len(baskets), len(pages))).tocsr()
+    # Repeat visits within a basket count once.
+    matrix.data[:] = 1
+    return matrix, pages
+
+
+def fold_clicks(cutoff, pause=0.1):
+    """Add the co-clicks of clicks before cutoff to CoClick and delete them.
+
+    Clicks are folded a few hundred sessions at a time, each chunk in its own
+    short transaction, so a whole basket is always folded and deleted
+    together. Returns the ids of the pages whose counts changed.
+    """
+    clicks = Click.objects.filter(timestamp__lt=cutoff)
+    sessions = list(clicks.order_by('session').values_list('session', flat=True).distinct())
+    changed = set()
+    for chunk in _chunks(sessions):
+        rows = list(clicks.filter(session__in=chunk).values_list('id', 'session', 'page', 'timestamp'))
+        matrix, pages = basket_matrix([row[1:] for row in rows])
+        delta = (matrix.T * matrix).tocoo()
+        upper = delta.row <= delta.col
+        counts = dict(((int(pages[a]), int(pages[b])), int(count))
+                      for a, b, count in zip(delta.row[upper], delta.col[upper], delta.data[upper]))
+
+        with transaction.atomic():
+            CoClick.objects.add_sessions(counts)
+            for click_ids in _chunks([row[0] for row in rows]):
+                Click.objects.filter(id__in=click_ids).delete()
+        changed.update(int(page_id) for page_id in pages)
+
+        # Give waiting writers a turn at the lock.
+        time.sleep(pause)
+    return sorted(changed)
+
+
+def co_clicks(page_ids):
+    """The CoClick rows involving any of the given pages, as {(page_a, page_b): sessions}."""
+    rows = {}
+    for chunk in _chunks(sorted(page_ids)):
+        for page_a, page_b, sessions in CoClick.objects.filter(Q(page_a__in=chunk) | Q(page_b__in=chunk)) \
+                .values_list('page_a', 'page_b', 'sessions'):
+            rows[page_a, page_b] = sessions
+    return rows
+
+
+def similarity_matrix(rows, min_sessions):
+    """Cosine similarity between pages from {(page_a, page_b): sessions}.
+
+    rows must hold the diagonal of every page it mentions. Returns the CSR
+    matrix, without its diagonal, and the page id of each row and column.
+    """
+    if not rows:
+        return sparse.csr_matrix((0, 0)), np.array([], dtype=np.int64)
+    pairs = np.array(rows.keys(), dtype=np.int64)
+    page_a, page_b = pairs[:, 0], pairs[:, 1]
+    sessions = np.array(rows.values(), dtype=np.float64)
+
+    pages, index = np.unique(np.concatenate([page_a, page_b]), return_inverse=True)
+    a, b = index[:len(page_a)], index[len(page_a):]
+    diagonal = np.zeros(len(pages))
+    diagonal[a[a == b]] = sessions[a == b]
+
+    # Pairs seen in too few sessions are noise.
+    pairs = (a != b) & (sessions >= min_sessions)
+    co = sparse.coo_matrix((sessions[pairs], (a[pairs], b[pairs])), shape=(len(pages), len(pages)))
+    co = (co + co.T).tocsr()
+
+    norm = sparse.diags(1 / np.sqrt(np.maximum(diagonal, 1)))
+    return (norm * co * norm).tocsr(), pages
+
+
+def update_related_pages(page_ids, limit=None, min_sessions=None):
+    """Recompute RelatedPage rows for the given pages and their neighbours.
+
+    The neighbours are included because their scores depend on how many
+    sessions visited the given pages. Only the CoClick rows of these pages
+    and the diagonals of their partners are loaded.
+    """
+    limit = limit or settings.RELATED_PAGES
+    min_sessions = min_sessions or settings.RELATED_PAGES_MIN_SESSIONS
+
+    rows = co_clicks(page_ids)
+    affected = set(page_ids)
+    for (page_a, page_b), sessions in rows.items():
+        if page_a != page_b and sessions >= min_sessions:
+            affected.update((page_a, page_b))
+    rows.update(co_clicks(affected - set(page_ids)))
+
+    partners = set(page_id for pair in rows for page_id in pair) - affected
+    for chunk in _chunks(sorted(partners)):
+        for page_id, sessions in CoClick.objects.filter(page_a__in=chunk, page_b=F('page_a')) \
+                .values_list('page_a', 'sessions'):
+            rows[page_id, page_id] = sessions
+
+    similarity, pages = similarity_matrix(rows, min_sessions)
+    positions = dict((int(page_id), i) for i, page_id in enumerate(pages))
+
+    for chunk in _chunks(sorted(affected)):
+        related = []
+        for page_id in chunk:
+            i = positions.get(page_id)
+            if i is None:
+                continue
+            start, end = similarity.indptr[i], similarity.indptr[i + 1]
+            scores = similarity.data[start:end]
+            best = np.argsort(-scores)[:limit]
+            related.extend(RelatedPage(page_id=page_id, related_id=int(pages[similarity.indices[start + j]]),
+                                       score=float(scores[j])) for j in best)
+
+        # One short transaction per chunk keeps the write lock brief.
+        with transaction.atomic():
+            RelatedPage.objects.filter(page__in=chunk).delete()
+            RelatedPage.objects.bulk_create(related)
+
+
+def update_recommendations(now=None):
+    """Fold in the clicks of every finished day and refresh what they changed.
+
+    A day counts as finished settings.CLICK_FOLD_DELAY seconds after
+    midnight, once the buffered and queued clicks from its end have arrived.
+    """
+    now = (now or timezone.now()) - timedelta(seconds=settings.CLICK_FOLD_DELAY)
+    cutoff = timezone.make_aware(datetime.combine(now.date(), datetime.min.time()), timezone.utc)
+    changed = fold_clicks(cutoff)
+    if changed:
+        update_related_pages(changed)
+    return len(changed)
@@ -0,0 +1,134 @@
+"""
+Retention for the activity stream and upkeep of the SQLite database.
+
+Every action.send() adds a row to actstream's Action table. Actions older
+than their verb's policy in settings.ACTION_RETENTION_DAYS are moved, a
+chunk at a time, into gzipped JSON lines files under
+settings.ACTION_ARCHIVE_DIR. Each chunk is written and flushed before it is
+deleted in its own short transaction, so the write lock is never held for
+long. A crash between the two steps can leave a chunk in the archive twice
+but never loses it.
+"""
+
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+
+from actstream.models import Action
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.utils import timezone
+
+ARCHIVED_FIELDS = ('id', 'actor_content_type', 'actor_object_id', 'verb', 'description',
+                   'target_content_type', 'target_object_id',
+                   'action_object_content_type', 'action_object_object_id',
+                   'timestamp', 'public', 'data')
+
+
+def expired_actions(policies=None, now=None):
+    """Yield (verb, queryset) pairs of actions past their retention period.
+
+    policies maps verbs to a number of days, or None to keep forever. The
+    'default' entry covers every verb without its own entry.
+    """
+    policies = policies if policies is not None else settings.ACTION_RETENTION_DAYS
+    now = now or timezone.now()
+    verbs = [verb for verb in policies if verb != 'default']
+
+    for verb in verbs:
+        if policies[verb] is not None:
+            yield verb, Action.objects.filter(verb=verb, timestamp__lt=now - timedelta(days=policies[verb]))
+
+    if policies.get('default') is not None:
+        yield 'default', Action.objects.exclude(verb__in=verbs).filter(
+            timestamp__lt=now - timedelta(days=policies['default']))
+
+
+def _serialize(row):
+    for field in ('actor_content_type', 'target_content_type', 'action_object_content_type'):
+        if row[field] is not None:
+            # Content type ids differ between databases; labels do not.
+            content_type = ContentType.objects.get_for_id(row[field])
+            row[field] = content_type.app_label + '.' + content_type.model
+    row['timestamp'] = row['timestamp'].isoformat()
+    return json.dumps(row, default=unicode)
+
+
+def archive_actions(policies=None, chunk_size=500, pause=0.1, dry_run=False):
+    """Archive and delete expired actions. Returns {verb: count}."""
+    archived = {}
+    archive = None
+    try:
+        for verb, actions in expired_actions(policies):
+            if dry_run:
+                archived[verb] = actions.count()
+                continue
+
+            archived[verb] = 0
+            while True:
+                ids = list(actions.order_by('id').values_list('id', flat=True)[:chunk_size])
+                if not ids:
+                    break
+
+                if archive is None:
+                    archive = open_archive()
+                for row in Action.objects.filter(id__in=ids).values(*ARCHIVED_FIELDS):
+                    archive.write(_serialize(row) + '\n')
+                archive.flush()
+                os.fsync(archive.fileobj.fileno())
+
+                with transaction.atomic():
+                    Action.objects.filter(id__in=ids).delete()
+                archived[verb] += len(ids)
+
+                # Give waiting writers a turn at the lock.
+                time.sleep(pause)
+    finally:
+        if archive is not None:
+            archive.close()
+    return archived
+
+
+def open_archive():
+    if not os.path.isdir(settings.ACTION_ARCHIVE_DIR):
+        os.makedirs(settings.ACTION_ARCHIVE_DIR)
+    name = timezone.now().strftime('actions-%Y%m%d-%H%M%S.jsonl.gz')
+    return gzip.open(os.path.join(settings.ACTION_ARCHIVE_DIR, name), 'ab')
+
+
+def maintain_database(full=False, pages_per_step=256, pause=0.1):
+    """Refresh planner statistics and give free pages back to the filesystem.
+
+    A full VACUUM rewrites the whole file under an exclusive lock, so it is
+    only done when asked for. It also switches the database to incremental
+    auto-vacuum, after which the routine runs release free pages a few at a
+    time instead.
+    """
+    cursor = connection.cursor()
+    cursor.execute('ANALYZE')
+    if connection.vendor != 'sqlite':
+        return {'analyzed': True}
+
+    if full:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        return {'analyzed': True, 'vacuumed': True}
+
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        return {'analyzed': True, 'released': 0}
+
+    released = 0
+    while True:
+        cursor.execute('PRAGMA freelist_count')
+        free = cursor.fetchone()[0]
+        if not free:
+            break
+        cursor.execute('PRAGMA incremental_vacuum({0:d})'.format(min(free, pages_per_step)))
+        cursor.fetchall()
+        released += min(free, pages_per_step)
+        time.sleep(pause)
+    return {'analyzed': True, 'released': released}
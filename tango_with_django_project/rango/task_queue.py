@@ -0,0 +1,274 @@
+"""
+A small durable job queue for work that should not run inside a request.
+
+Jobs are stored in their own SQLite file (settings.TASK_QUEUE_PATH) so that
+queue traffic never competes with the site database for its write lock.
+Functions are turned into tasks with the @task decorator and queued with
+.delay(); the run_tasks management command executes them.
+"""
+
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from importlib import import_module
+
+from django.conf import settings
+from django.db import close_old_connections
+
+# Priority lanes. Lower numbers are claimed first.
+HIGH = 0
+DEFAULT = 5
+LOW = 9
+
+LANES = {'high': HIGH, 'default': DEFAULT, 'low': LOW}
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_retries INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    created REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS job_ready ON job (status, priority, run_at);
+COMMIT;
+"""
+
+_schema_ready = False
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_connection():
+    """Open a connection to the queue database, creating it if needed."""
+    global _schema_ready
+    path = _setting('TASK_QUEUE_PATH', os.path.join(settings.BASE_DIR, 'tasks.db'))
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _schema_ready:
+        # WAL lets the web processes enqueue while workers are claiming jobs.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        _schema_ready = True
+    return conn
+
+
+class Task(object):
+    """A function that can be run later by a worker."""
+
+    def __init__(self, func, priority=DEFAULT, max_retries=3):
+        self.func = func
+        self.priority = priority
+        self.max_retries = max_retries
+        self.name = '{0}.{1}'.format(func.__module__, func.__name__)
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        """Queue the task with the given arguments.
+
+        Arguments must be JSON serializable. The special keyword arguments
+        idempotency_key, priority and countdown (seconds) are consumed here
+        and not passed on to the task. Returns the job id, or None if the job
+        was run eagerly or a job with the same idempotency key already exists.
+        """
+        idempotency_key = kwargs.pop('idempotency_key', None)
+        priority = kwargs.pop('priority', self.priority)
+        countdown = kwargs.pop('countdown', 0)
+
+        if _setting('TASK_ALWAYS_EAGER', False):
+            self.func(*args, **kwargs)
+            return None
+
+        return enqueue(self.name, args, kwargs, priority=priority, max_retries=self.max_retries,
+                       idempotency_key=idempotency_key, countdown=countdown)
+
+
+def task(func=None, priority=DEFAULT, max_retries=3):
+    """Decorator turning a module level function into a Task.
+
+    Can be used bare (@task) or with options (@task(priority=LOW)).
+    """
+    if func is not None:
+        return Task(func, priority, max_retries)
+
+    def decorator(f):
+        return Task(f, priority, max_retries)
+
+    return decorator
+
+
+def enqueue(name, args=(), kwargs=None, priority=DEFAULT, max_retries=3, idempotency_key=None, countdown=0):
+    now = time.time()
+    conn = get_connection()
+    try:
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO job (name, args, kwargs, priority, idempotency_key, status, '
+            'max_retries, run_at, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (name, json.dumps(list(args)), json.dumps(kwargs or {}), priority, idempotency_key,
+             QUEUED, max_retries, now + countdown, now))
+        return cursor.lastrowid if cursor.rowcount else None
+    finally:
+        conn.close()
+
+
+def resolve(name):
+    """Import the Task registered under the given dotted name."""
+    module_name, func_name = name.rsplit('.', 1)
+    return getattr(import_module(module_name), func_name)
+
+
+def claim(conn, worker_id, priorities=None):
+    """Atomically mark the next runnable job as running and return it."""
+    now = time.time()
+    lock_timeout = _setting('TASK_LOCK_TIMEOUT', 600)
+    where = 'status = ? AND run_at <= ?'
+    params = [QUEUED, now]
+    if priorities:
+        where += ' AND priority IN ({0})'.format(', '.join('?' * len(priorities)))
+        params.extend(priorities)
+
+    # BEGIN IMMEDIATE takes the write lock up front so two workers can never
+    # claim the same row.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Jobs whose worker died mid-run are put back on the queue, unless
+        # that was their last attempt; a job that keeps killing its worker
+        # must not be retried forever.
+        conn.execute('UPDATE job SET status = ?, locked_by = NULL, last_error = ? '
+                     'WHERE status = ? AND locked_at < ? AND attempts > max_retries',
+                     (FAILED, 'Worker lost.', RUNNING, now - lock_timeout))
+        conn.execute('UPDATE job SET status = ?, locked_by = NULL WHERE status = ? AND locked_at < ?',
+                     (QUEUED, RUNNING, now - lock_timeout))
+        row = conn.execute('SELECT * FROM job WHERE {0} ORDER BY priority, run_at, id LIMIT 1'.format(where),
+                           params).fetchone()
+        if row is not None:
+            conn.execute('UPDATE job SET status = ?, locked_by = ?, locked_at = ?, attempts = attempts + 1 '
+                         'WHERE id = ?', (RUNNING, worker_id, now, row['id']))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return row
+
+
+def backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts` times."""
+    base = _setting('TASK_RETRY_BACKOFF', 10)
+    return base * (2 ** (attempts - 1)) * random.uniform(1, 1.5)
+
+
+def run_job(conn, row):
+    """Run a claimed job and record the outcome. Returns True on success."""
+    try:
+        resolve(row['name']).func(*json.loads(row['args']), **json.loads(row['kwargs']))
+    except Exception:
+        error = traceback.format_exc()
+        attempts = row['attempts'] + 1
+        if attempts > row['max_retries']:
+            conn.execute('UPDATE job SET status = ?, locked_by = NULL, last_error = ? WHERE id = ?',
+                         (FAILED, error, row['id']))
+        else:
+            conn.execute('UPDATE job SET status = ?, locked_by = NULL, last_error = ?, run_at = ? WHERE id = ?',
+                         (QUEUED, error, time.time() + backoff(attempts), row['id']))
+        return False
+
+    conn.execute('UPDATE job SET status = ?, locked_by = NULL, last_error = NULL WHERE id = ?', (DONE, row['id']))
+    return True
+
+
+class Heartbeat(threading.Thread):
+    """Refreshes a running job's lock so that a long job is not taken for lost.
+
+    Only a worker that has died stops refreshing, so TASK_LOCK_TIMEOUT bounds
+    how long its job waits to be recovered, not how long a job may run.
+    """
+
+    def __init__(self, job_id, worker_id, interval):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = get_connection()
+        try:
+            while not self.stopped.wait(self.interval):
+                conn.execute('UPDATE job SET locked_at = ? WHERE id = ? AND locked_by = ?',
+                             (time.time(), self.job_id, self.worker_id))
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(priorities=None, burst=False, poll_interval=1.0, should_stop=lambda: False):
+    """Claim and run jobs until should_stop() is true.
+
+    With burst=True the loop returns as soon as no job is ready.
+    """
+    worker_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    conn = get_connection()
+    try:
+        while not should_stop():
+            row = claim(conn, worker_id, priorities)
+            if row is None:
+                if burst:
+                    return
+                time.sleep(poll_interval)
+                continue
+            heartbeat = Heartbeat(row['id'], worker_id, _setting('TASK_LOCK_TIMEOUT', 600) / 3.0)
+            heartbeat.start()
+            try:
+                run_job(conn, row)
+            finally:
+                heartbeat.stop()
+            # Workers are long lived, so drop ORM connections the way the
+            # request cycle would.
+            close_old_connections()
+    finally:
+        conn.close()
+
+
+def purge(older_than=None):
+    """Delete done and failed jobs older than the given number of seconds.
+
+    Defaults to settings.TASK_PURGE_AFTER.
+    """
+    if older_than is None:
+        older_than = _setting('TASK_PURGE_AFTER', 7 * 86400)
+    conn = get_connection()
+    try:
+        return conn.execute('DELETE FROM job WHERE status IN (?, ?) AND created < ?',
+                            (DONE, FAILED, time.time() - older_than)).rowcount
+    finally:
+        conn.close()
@@ -0,0 +1,205 @@
+__author__ = 'Cheng'
+
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime
+
+from actstream import action
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, get_model
+from django.utils.timezone import utc
+from PIL import Image
+
+from bing_search import run_query
+from models import Click, UserProfile
+from retention import archive_actions, maintain_database
+from task_queue import task, enqueue, purge, HIGH, DEFAULT, LOW
+
+logger = logging.getLogger(__name__)
+
+
+def ref(obj):
+    """A JSON friendly reference to a model instance, e.g. ['rango.page', 3]."""
+    return [obj._meta.app_label + '.' + obj._meta.model_name, obj.pk]
+
+
+def deref(reference):
+    if reference is None:
+        return None
+    label, pk = reference
+    app_label, model_name = label.split('.')
+    return get_model(app_label, model_name)._default_manager.get(pk=pk)
+
+
+@task(priority=HIGH)
+def increment_counter(obj, field, amount=1):
+    """Add amount to an integer field, e.g. a page's views."""
+    label, pk = obj
+    app_label, model_name = label.split('.')
+    get_model(app_label, model_name)._default_manager.filter(pk=pk).update(**{field: F(field) + amount})
+
+
+@task(priority=HIGH)
+def record_action(actor, verb, action_object=None, target=None, timestamp=None):
+    kwargs = {}
+    if action_object is not None:
+        kwargs['action_object'] = deref(action_object)
+    if target is not None:
+        kwargs['target'] = deref(target)
+    if timestamp is not None:
+        # Keep the time the user acted, not the time the worker got to it.
+        kwargs['timestamp'] = datetime.fromtimestamp(timestamp, utc)
+    action.send(deref(actor), verb=verb, **kwargs)
+
+
+def defer_action(actor, verb, action_object=None, target=None):
+    """Queue an actstream action.send() for the given objects."""
+    refs = [ref(actor), None, None]
+    if action_object is not None:
+        refs[1] = ref(action_object)
+    if target is not None:
+        refs[2] = ref(target)
+    key = 'action:{0}:{1}'.format(verb, refs)
+    return record_action.delay(refs[0], verb, action_object=refs[1], target=refs[2], timestamp=time.time(),
+                               idempotency_key=key)
+
+
+def search_cache_key(query):
+    return 'bing:' + hashlib.md5(query.lower().encode('utf-8')).hexdigest()
+
+
+def search_results(query):
+    """Cached results for query, or None after queueing a worker to fetch them.
+
+    Bing is never called on the request path; the page shows the search as
+    pending and the results once a worker has cached them.
+    """
+    key = search_cache_key(query)
+    results = cache.get(key)
+    if not results:
+        defer_prefetch_search(query)
+        # In eager mode the prefetch has already run.
+        results = cache.get(key)
+    return results or None
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+@task(priority=LOW)
+def prefetch_search(query):
+    results = run_query(query)
+    if not results:
+        # Raising lets the queue retry later instead of caching a failure.
+        raise SearchUnavailable('No results for {0!r}.'.format(query))
+    cache.set(search_cache_key(query), results, settings.SEARCH_CACHE_TIMEOUT)
+
+
+def defer_prefetch_search(query):
+    """Queue a search prefetch unless the results are already cached."""
+    key = search_cache_key(query)
+    if not cache.get(key):
+        # One prefetch per query per cache period is plenty.
+        window = int(time.time() // settings.SEARCH_CACHE_TIMEOUT)
+        return prefetch_search.delay(query, idempotency_key='{0}:{1}'.format(key, window))
+
+
+@task(priority=DEFAULT)
+def process_profile_image(profile_id):
+    """Shrink an uploaded profile picture to settings.PROFILE_IMAGE_SIZE."""
+    profile = UserProfile.objects.get(id=profile_id)
+    if not profile.picture:
+        return
+
+    image = Image.open(profile.picture.path)
+    if image.size[0] > settings.PROFILE_IMAGE_SIZE[0] or image.size[1] > settings.PROFILE_IMAGE_SIZE[1]:
+        image.thumbnail(settings.PROFILE_IMAGE_SIZE, Image.ANTIALIAS)
+        image.save(profile.picture.path)
+
+
+@task(priority=LOW)
+def store_clicks(clicks):
+    Click.objects.bulk_create([Click(session=session, page_id=page_id, timestamp=datetime.fromtimestamp(timestamp, utc))
+                               for session, page_id, timestamp in clicks])
+
+
+_clicks = []
+_clicks_lock = threading.Lock()
+_clicks_timer = [None]
+
+
+def defer_click(session_key, page_id):
+    """Buffer a click for the recommender, storing them in batches.
+
+    The buffer is per process and is flushed every settings.CLICK_BATCH_SIZE
+    clicks, settings.CLICK_FLUSH_INTERVAL seconds after its first click, and
+    when the process exits.
+    """
+    session = hashlib.sha1(session_key).hexdigest()
+    with _clicks_lock:
+        _clicks.append((session, page_id, time.time()))
+        if len(_clicks) < settings.CLICK_BATCH_SIZE:
+            if _clicks_timer[0] is None:
+                # A timer, so that a quiet process does not sit on its clicks.
+                _clicks_timer[0] = threading.Timer(settings.CLICK_FLUSH_INTERVAL, flush_clicks)
+                _clicks_timer[0].daemon = True
+                _clicks_timer[0].start()
+            return None
+    return flush_clicks()
+
+
+@atexit.register
+def flush_clicks():
+    """Store the buffered clicks now."""
+    with _clicks_lock:
+        batch = _clicks[:]
+        del _clicks[:]
+        if _clicks_timer[0] is not None:
+            _clicks_timer[0].cancel()
+            _clicks_timer[0] = None
+    if batch:
+        return store_clicks.delay(batch)
+
+
+@task(priority=LOW, max_retries=1)
+def refresh_recommendations():
+    # Imported here so that only the workers load NumPy and SciPy.
+    from recommendations import update_recommendations
+
+    update_recommendations()
+
+
+def queue_recommendations():
+    """Queue refresh_recommendations as a job of its own, with its own retries."""
+    window = int(time.time() // settings.DB_MAINTENANCE_INTERVAL)
+    return refresh_recommendations.delay(idempotency_key='recommendations:{0}'.format(window))
+
+
+@task(priority=LOW, max_retries=1)
+def nightly_maintenance():
+    # Schedule the next run first so that a failing step cannot end the cycle.
+    schedule_maintenance()
+    # The steps are independent, so one failing does not skip the rest.
+    # Recommendations come last, after retention has freed up the database.
+    for step in (archive_actions, maintain_database, purge, queue_recommendations):
+        try:
+            step()
+        except Exception:
+            logger.exception('Maintenance step %s failed.', step.__name__)
+
+
+def schedule_maintenance():
+    """Queue the next maintenance run at the start of the next interval.
+
+    This always goes through the queue, even in eager mode, since the task
+    schedules itself.
+    """
+    interval = settings.DB_MAINTENANCE_INTERVAL
+    next_run = (int(time.time() // interval) + 1) * interval
+    return enqueue(nightly_maintenance.name, priority=LOW, max_retries=nightly_maintenance.max_retries,
+                   idempotency_key='maintenance:{0}'.format(next_run), countdown=next_run - time.time())
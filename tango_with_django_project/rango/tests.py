@@ -1 +1,456 @@
-# Create your tests here.
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from actstream.models import Action
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.core.cache import cache
+from django.core.urlresolvers import clear_url_caches, get_resolver, resolve
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.timezone import utc
+
+import admission
+import task_queue
+import tasks
+from admission import AdmissionControlMiddleware, SharedState
+from models import CATEGORY_LIST_CACHE_KEY, TOP_PAGES_CACHE_KEY, Category, Page, Click, CoClick
+from retention import archive_actions, expired_actions, maintain_database
+from recommendations import basket_matrix, fold_clicks, update_recommendations
+from task_queue import task
+from tasks import increment_counter, ref, search_cache_key, defer_click, flush_clicks
+from urlnorm import canonicalize, url_hash, url_key
+from tango_with_django_project.warmup import profile_imports, resolve_urls, warm_up
+
+
+class CanonicalizeTests(TestCase):
+    def test_adds_scheme_and_normalizes_host(self):
+        self.assertEqual(canonicalize(u'  WWW.Example.COM  '), u'http://www.example.com/')
+        self.assertEqual(canonicalize('HTTPS://Example.com:443/a'), u'https://example.com/a')
+        self.assertEqual(canonicalize('example.com:8080/a'), u'http://example.com:8080/a')
+
+    def test_keeps_where_the_link_goes(self):
+        self.assertEqual(canonicalize('docs.python.org/2/library/os.html#os.walk'),
+                         u'http://docs.python.org/2/library/os.html#os.walk')
+        self.assertEqual(canonicalize('example.com/login?next=http://foo.com&flag'),
+                         u'http://example.com/login?next=http://foo.com&flag')
+
+    def test_url_key_drops_tracking_params_and_sorts_query(self):
+        self.assertEqual(url_key('http://example.com/?utm_source=x&b=2&gclid=y&a=1#top'), u'example.com/?a=1&b=2')
+        self.assertEqual(url_key('github.com/x/y/tree?ref=main'), u'github.com/x/y/tree?ref=main')
+
+    def test_url_hash_ignores_scheme_and_trailing_slash(self):
+        self.assertEqual(url_hash('http://example.com/docs/'), url_hash('https://EXAMPLE.com/docs?utm_medium=x'))
+        self.assertNotEqual(url_hash('http://example.com/docs'), url_hash('http://example.com/docs?page=2'))
+
+
+calls = []
+
+
+@task(max_retries=1)
+def flaky(fail):
+    calls.append(fail)
+    if fail:
+        raise ValueError('boom')
+
+
+@task
+def slow():
+    time.sleep(0.3)
+    # The job's lock has outlived TASK_LOCK_TIMEOUT, but its heartbeat keeps
+    # another worker from taking it.
+    conn = task_queue.get_connection()
+    try:
+        calls.append(task_queue.claim(conn, 'other'))
+    finally:
+        conn.close()
+
+
+class QueueTestCase(TestCase):
+    """Runs each test against its own empty queue."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(TASK_QUEUE_PATH=os.path.join(self.directory, 'tasks.db'),
+                                          TASK_ALWAYS_EAGER=False, TASK_RETRY_BACKOFF=10)
+        self.settings.enable()
+        task_queue._schema_ready = False
+        del calls[:]
+
+    def tearDown(self):
+        self.settings.disable()
+        task_queue._schema_ready = False
+        shutil.rmtree(self.directory)
+
+    def jobs(self):
+        conn = task_queue.get_connection()
+        try:
+            return [dict(row) for row in conn.execute('SELECT * FROM job ORDER BY id')]
+        finally:
+            conn.close()
+
+
+class TaskQueueTests(QueueTestCase):
+    def test_idempotency_key(self):
+        self.assertIsNotNone(flaky.delay(False, idempotency_key='once'))
+        self.assertIsNone(flaky.delay(False, idempotency_key='once'))
+        self.assertEqual(len(self.jobs()), 1)
+
+    def test_backoff_doubles(self):
+        for attempts in (1, 2, 3):
+            delay = task_queue.backoff(attempts)
+            self.assertTrue(10 * 2 ** (attempts - 1) <= delay <= 15 * 2 ** (attempts - 1))
+
+    def test_failed_job_is_retried_then_failed(self):
+        flaky.delay(True)
+        task_queue.work(burst=True)
+        job = self.jobs()[0]
+        self.assertEqual((job['status'], job['attempts']), (task_queue.QUEUED, 1))
+        self.assertTrue(job['run_at'] >= time.time() + 9)
+
+        # Nothing runs again until the backoff has passed.
+        task_queue.work(burst=True)
+        self.assertEqual(calls, [True])
+
+        conn = task_queue.get_connection()
+        conn.execute('UPDATE job SET run_at = 0')
+        conn.close()
+        task_queue.work(burst=True)
+        job = self.jobs()[0]
+        self.assertEqual((job['status'], job['attempts']), (task_queue.FAILED, 2))
+        self.assertIn('ValueError', job['last_error'])
+
+    def test_lost_job_out_of_retries_is_failed(self):
+        flaky.delay(False)
+        conn = task_queue.get_connection()
+        conn.execute('UPDATE job SET status = ?, attempts = 2, locked_at = 0', (task_queue.RUNNING,))
+        self.assertIsNone(task_queue.claim(conn, 'test'))
+        conn.close()
+        self.assertEqual(self.jobs()[0]['status'], task_queue.FAILED)
+
+    def test_heartbeat_keeps_long_job_locked(self):
+        slow.delay()
+        with override_settings(TASK_LOCK_TIMEOUT=0.15):
+            task_queue.work(burst=True)
+        self.assertEqual(calls, [None])
+        self.assertEqual(self.jobs()[0]['status'], task_queue.DONE)
+
+    def test_eager_mode_runs_immediately(self):
+        category = Category.objects.create(name='Eager')
+        with override_settings(TASK_ALWAYS_EAGER=True):
+            self.assertIsNone(increment_counter.delay(ref(category), 'likes', 2))
+        self.assertEqual(Category.objects.get(id=category.id).likes, 2)
+        self.assertEqual(self.jobs(), [])
+
+
+class WarmUpTests(TestCase):
+    def setUp(self):
+        Category.objects.create(name='Python')
+        cache.set(CATEGORY_LIST_CACHE_KEY, ['served'])
+        cache.delete(TOP_PAGES_CACHE_KEY)
+
+    def tearDown(self):
+        cache.delete_many([CATEGORY_LIST_CACHE_KEY, TOP_PAGES_CACHE_KEY])
+
+    def test_warm_up(self):
+        timings = warm_up()
+        self.assertEqual([step for step, seconds in timings], ['urls', 'templates', 'caches', 'fork prep'])
+        # Entries other workers may be serving are left alone, missing ones are filled.
+        self.assertEqual(cache.get(CATEGORY_LIST_CACHE_KEY), ['served'])
+        self.assertEqual(cache.get(TOP_PAGES_CACHE_KEY), [])
+
+    def test_resolve_urls(self):
+        clear_url_caches()
+        resolve_urls()
+        self.assertTrue(get_resolver(None)._reverse_dict)
+
+    def test_profile_imports(self):
+        report = profile_imports()
+        self.assertIn('django.core.wsgi', report['imports'])
+        self.assertGreater(report['import_time'], 0)
+        # Its caches step fails on a database that has not been migrated yet.
+        steps = [step.replace(' (failed)', '') for step, seconds in report['warm_up']]
+        self.assertEqual(steps, ['urls', 'templates', 'caches', 'fork prep'])
+        # The child process warms a cache of its own.
+        self.assertEqual(cache.get(CATEGORY_LIST_CACHE_KEY), ['served'])
+        self.assertIsNone(cache.get(TOP_PAGES_CACHE_KEY))
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('ann', password='ann')
+        self.now = timezone.now()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def act(self, verb, days):
+        return Action.objects.create(actor=self.user, verb=verb, timestamp=self.now - timedelta(days=days))
+
+    def test_expired_actions(self):
+        liked, recently_liked = self.act('liked', 40), self.act('liked', 10)
+        added, registered = self.act('added', 40), self.act('just registered', 400)
+
+        policies = {'default': 30, 'liked': 20, 'just registered': None}
+        expired = dict((verb, list(actions.values_list('id', flat=True)))
+                       for verb, actions in expired_actions(policies, self.now))
+        self.assertEqual(expired, {'liked': [liked.id], 'default': [added.id]})
+
+        # Without a default, verbs that have no policy of their own are kept.
+        expired = [verb for verb, actions in expired_actions({'liked': 20, 'default': None}, self.now)]
+        self.assertEqual(expired, ['liked'])
+
+    def test_archive_actions(self):
+        expired = [self.act('liked', 40).id for i in range(5)]
+        kept = self.act('liked', 1)
+
+        with override_settings(ACTION_ARCHIVE_DIR=self.directory):
+            self.assertEqual(archive_actions({'default': 30}, dry_run=True), {'default': 5})
+            self.assertEqual(Action.objects.count(), 6)
+            self.assertEqual(archive_actions({'default': 30}, chunk_size=2, pause=0), {'default': 5})
+        self.assertEqual(list(Action.objects.values_list('id', flat=True)), [kept.id])
+
+        archives = os.listdir(self.directory)
+        self.assertEqual(len(archives), 1)
+        archive = gzip.open(os.path.join(self.directory, archives[0]))
+        rows = [json.loads(line) for line in archive]
+        archive.close()
+        self.assertEqual([row['id'] for row in rows], expired)
+        self.assertEqual((rows[0]['verb'], rows[0]['actor_content_type'], rows[0]['actor_object_id']),
+                         ('liked', 'auth.user', str(self.user.id)))
+
+
+class MaintenanceTests(TransactionTestCase):
+    def test_maintain_database(self):
+        self.assertEqual(maintain_database(pause=0), {'analyzed': True, 'released': 0})
+        # VACUUM cannot run in a transaction, hence TransactionTestCase.
+        self.assertEqual(maintain_database(full=True), {'analyzed': True, 'vacuumed': True})
+
+        Category.objects.bulk_create([Category(name='Category {0}'.format(i) * 10) for i in range(500)])
+        Category.objects.all().delete()
+        result = maintain_database(pause=0)
+        self.assertGreater(result['released'], 0)
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = SharedState(os.path.join(self.directory, 'admission'), 1, 1, 16, 0.05)
+        admission._state = self.state
+
+    def tearDown(self):
+        admission._state = None
+        shutil.rmtree(self.directory)
+
+    def test_take_tokens(self):
+        limits = [('client:a', 1.0, 2)]
+        self.assertEqual(self.state.take_tokens(limits, 100.0), 0)
+        self.assertEqual(self.state.take_tokens(limits, 100.0), 0)
+        self.assertAlmostEqual(self.state.take_tokens(limits, 100.0), 1.0)
+        self.assertEqual(self.state.take_tokens(limits, 101.0), 0)
+        # Other clients have their own bucket.
+        self.assertEqual(self.state.take_tokens([('client:b', 1.0, 2)], 101.0), 0)
+
+    def test_acquire_writer(self):
+        writer = self.state.acquire_writer(0, 0.01)
+        self.assertIsNotNone(writer)
+        self.assertIsNone(self.state.acquire_writer(0.02, 0.01))
+        self.state.release_writer(writer)
+        self.assertIsNotNone(self.state.acquire_writer(0, 0.01))
+        self.assertEqual(self.state.metrics()['admitted'], 2)
+
+    def test_slot_held_too_long_is_reclaimed(self):
+        leaked = self.state.acquire_writer(0, 0.01)
+        time.sleep(0.1)
+        writer = self.state.acquire_writer(0, 0.01)
+        self.assertIsNotNone(writer)
+        # The original holder releasing late must not free the new owner's slot.
+        self.state.release_writer(leaked)
+        self.assertEqual(self.state.metrics()['writers'], 1)
+
+    def test_layouts_get_files_of_their_own(self):
+        self.state.take_tokens([('client:a', 1.0, 2)], 100.0)
+        bigger = SharedState(os.path.join(self.directory, 'admission'), 2, 1, 16, 0.05)
+        self.assertNotEqual(bigger.path, self.state.path)
+        self.assertEqual(bigger.take_tokens([('client:a', 1.0, 2)], 100.0), 0)
+        self.assertEqual(os.path.getsize(self.state.path), self.state.size)
+        self.assertEqual(self.state.metrics()['writers'], 0)
+
+    def process_view(self, path, user_id, **config):
+        limits = dict(settings.ADMISSION_CONTROL, **config)
+        request = RequestFactory().get(path)
+        request.user = User(pk=user_id)
+        request.resolver_match = resolve(path)
+        with override_settings(ADMISSION_CONTROL=limits):
+            response = AdmissionControlMiddleware().process_view(request, None, (), {})
+            AdmissionControlMiddleware().release(request)
+        return response, request
+
+    def test_client_limit_is_hard_on_deferring_routes(self):
+        self.state.take_tokens([('client:user:1', 1.0, 1)], time.time())
+        response, request = self.process_view('/rango/goto/', 1, CLIENT_RATE=0.001, CLIENT_BURST=1)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(getattr(request, 'defer_writes', False))
+
+        # A busy route still defers, for clients within their limit.
+        self.state.take_tokens([('route:track_url', 1.0, 1)], time.time())
+        response, request = self.process_view('/rango/goto/', 2, ROUTE_RATE=0.001, ROUTE_BURST=1)
+        self.assertIsNone(response)
+        self.assertTrue(request.defer_writes)
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Python')
+        self.pages = [Page.objects.create(category=category, title=str(i), url='http://example.com/{0}'.format(i))
+                      for i in range(3)]
+
+    def test_basket_matrix(self):
+        day = datetime(2014, 1, 1, 12)
+        a, b = self.pages[0].id, self.pages[1].id
+        matrix, pages = basket_matrix([('s1', a, day), ('s1', a, day), ('s1', b, day),
+                                       ('s1', b, day + timedelta(days=1)), ('s2', b, day)])
+        self.assertEqual(list(pages), [a, b])
+        # Baskets are per session and day, and repeat visits count once.
+        self.assertEqual(sorted(map(list, matrix.toarray())), [[0, 1], [0, 1], [1, 1]])
+
+    def test_fold_clicks(self):
+        a, b, c = [page.id for page in self.pages]
+        yesterday = timezone.now() - timedelta(days=1)
+        Click.objects.bulk_create([Click(session=session, page_id=page_id, timestamp=yesterday)
+                                   for session, page_id in [('s1', a), ('s1', b), ('s2', a), ('s2', b), ('s3', c)]])
+        CoClick.objects.create(page_a_id=a, page_b_id=b, sessions=3)
+
+        changed = fold_clicks(timezone.now(), pause=0)
+        self.assertEqual(changed, [a, b, c])
+        self.assertFalse(Click.objects.exists())
+        counts = dict(((co_click.page_a_id, co_click.page_b_id), co_click.sessions)
+                      for co_click in CoClick.objects.all())
+        self.assertEqual(counts, {(a, a): 2, (a, b): 5, (b, b): 2, (c, c): 1})
+
+    def test_days_are_folded_after_a_grace_period(self):
+        Click.objects.create(session='s1', page=self.pages[0], timestamp=datetime(2014, 1, 1, 23, 59, tzinfo=utc))
+        with override_settings(CLICK_FOLD_DELAY=2 * 60 * 60):
+            self.assertEqual(update_recommendations(now=datetime(2014, 1, 2, 1, 0, tzinfo=utc)), 0)
+            self.assertEqual(update_recommendations(now=datetime(2014, 1, 2, 3, 0, tzinfo=utc)), 1)
+
+    def test_click_buffer_is_flushed(self):
+        page_id = self.pages[0].id
+        with override_settings(TASK_ALWAYS_EAGER=True, CLICK_BATCH_SIZE=3, CLICK_FLUSH_INTERVAL=60):
+            defer_click('session', page_id)
+            self.assertIsNotNone(tasks._clicks_timer[0])
+            self.assertFalse(Click.objects.exists())
+
+            flush_clicks()
+            self.assertIsNone(tasks._clicks_timer[0])
+            self.assertEqual(Click.objects.count(), 1)
+
+            for i in range(3):
+                defer_click('session', page_id)
+            self.assertEqual(Click.objects.count(), 4)
+
+
+class MergeTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Django')
+
+    def test_dedupe_pages_sums_views(self):
+        keep = Page.objects.create(category=self.category, title='Docs', url='http://djangoproject.com/', views=3)
+        copy = Page.objects.create(category=self.category, title='Docs', url='http://example.org/', views=4)
+        Page.objects.create(category=self.category, title='Other', url='http://example.com/', views=1)
+        # A copy left with a stale hash, as after a change to the URL rules.
+        Page.objects.filter(id=copy.id).update(url='https://DjangoProject.com?utm_source=x')
+
+        call_command('dedupe_pages', stdout=open(os.devnull, 'w'))
+        self.assertEqual(Page.objects.count(), 2)
+        self.assertEqual(Page.objects.get(id=keep.id).views, 7)
+
+    def test_url_is_unique_per_category(self):
+        Page.objects.create(category=self.category, title='Docs', url='http://djangoproject.com/')
+        Page.objects.create(category=Category.objects.create(name='Python'), title='Docs',
+                            url='http://djangoproject.com/')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Page.objects.create(category=self.category, title='Docs', url='https://djangoproject.com')
+
+
+class PageAdminTests(TestCase):
+    def setUp(self):
+        self.python = Category.objects.create(name='Python')
+        self.django = Category.objects.create(name='Django')
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def action(self, action, pages, **data):
+        data.update({'action': action, 'index': 0, '_selected_action': [page.id for page in pages]})
+        return self.client.post('/admin/rango/page/', data)
+
+    def test_merge_requires_same_url_and_category(self):
+        pages = [Page.objects.create(category=category, title='Page', url=url, views=1)
+                 for category, url in ((self.python, 'http://a.com/'), (self.python, 'http://b.com/'),
+                                       (self.django, 'http://a.com/'), (self.python, 'http://c.com/'))]
+        # A copy left with a stale hash, as after a change to the URL rules.
+        Page.objects.filter(id=pages[3].id).update(url='https://a.com')
+
+        self.action('merge_pages', pages[:2])
+        self.action('merge_pages', [pages[0], pages[2]])
+        self.assertEqual(Page.objects.count(), 4)
+
+        self.action('merge_pages', [pages[0], pages[3]])
+        self.assertEqual(Page.objects.count(), 3)
+        self.assertEqual(Page.objects.get(id=pages[0].id).views, 2)
+
+    def test_recategorize_select_across(self):
+        pages = [Page.objects.create(category=self.python, title=str(i), url='http://example.com/{0}'.format(i))
+                 for i in range(30)]
+
+        response = self.action('recategorize', pages[:1], select_across=1)
+        self.assertEqual(response.context['count'], 30)
+        self.assertEqual(len(response.context['sample']), 20)
+        self.assertEqual(response.content.count('name="_selected_action"'), 1)
+
+        self.action('recategorize', pages[:1], select_across=1, apply='yes', category=self.django.id)
+        self.assertEqual(Page.objects.filter(category=self.django).count(), 30)
+
+    def test_recategorize_refuses_duplicates(self):
+        Page.objects.create(category=self.django, title='Docs', url='http://a.com/')
+        page = Page.objects.create(category=self.python, title='Docs', url='https://a.com')
+
+        response = self.action('recategorize', [page], apply='yes', category=self.django.id)
+        self.assertTrue(response.context['form'].errors)
+        self.assertEqual(Page.objects.get(id=page.id).category, self.python)
+
+
+class SearchTests(QueueTestCase):
+    query = 'rango search test'
+
+    def setUp(self):
+        super(SearchTests, self).setUp()
+        Category.objects.create(name='Python')
+        self.run_query = tasks.run_query
+        tasks.run_query = lambda query: [{'title': 'Rango', 'link': 'http://example.com/', 'summary': query}]
+
+    def tearDown(self):
+        tasks.run_query = self.run_query
+        cache.delete(search_cache_key(self.query))
+        super(SearchTests, self).tearDown()
+
+    def test_search_is_fetched_by_a_worker(self):
+        response = self.client.post('/rango/category/python/', {'query': self.query})
+        self.assertTrue(response.context['search_pending'])
+        self.assertEqual([job['name'] for job in self.jobs()], [tasks.prefetch_search.name])
+
+        task_queue.work(burst=True)
+        response = self.client.post('/rango/category/python/', {'query': self.query})
+        self.assertFalse(response.context['search_pending'])
+        self.assertEqual(response.context['result_list'][0]['summary'], self.query)
+
@@ -0,0 +1,70 @@
+__author__ = 'Cheng'
+
+import hashlib
+import urllib
+import urlparse
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+
+# Query parameters that only track where a click came from. Generic names
+# such as 'ref' are left alone since sites use them for content
+# (github.com/x/y/tree?ref=main).
+TRACKING_PARAMS = ('fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'yclid', '_ga')
+TRACKING_PREFIXES = ('utm_',)
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def _split(url):
+    """urlsplit() with a missing http:// scheme added and the host cleaned up."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    url = url.strip()
+    # Look at the parsed URL rather than for '://', which can turn up in the
+    # query (example.com/login?next=http://foo.com). Without a host the
+    # scheme is missing, or was misread from host:port (example.com:8080).
+    if not urlparse.urlsplit(url).netloc:
+        url = 'http://' + url
+
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    scheme = (scheme or 'http').lower()
+
+    userinfo, _, hostport = netloc.rpartition('@')
+    host, _, port = hostport.partition(':')
+    host = host.lower().rstrip('.')
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = host + ':' + port
+    netloc = userinfo + '@' + host if userinfo else host
+    return scheme, netloc, path, query, fragment
+
+
+def canonicalize(url):
+    """Return the URL to store for url.
+
+    Adds a missing http:// scheme, lowercases the scheme and host and drops
+    default ports. The path, query and fragment are kept as given, since
+    they decide where the link goes; url_key() is what ignores them.
+    """
+    scheme, netloc, path, query, fragment = _split(url)
+    return urlparse.urlunsplit((scheme, netloc, path or '/', query, fragment)).decode('utf-8')
+
+
+def url_key(url):
+    """The part of a URL two pages must share to be duplicates.
+
+    http and https, a trailing slash on the path, fragments, tracking
+    parameters and the order of the query are not significant.
+    """
+    scheme, netloc, path, query, fragment = _split(url)
+    params = [(name, value) for name, value in urlparse.parse_qsl(query, keep_blank_values=True)
+              if not is_tracking_param(name)]
+    query = urllib.urlencode(sorted(params))
+    return (netloc + (path.rstrip('/') or '/') + ('?' + query if query else '')).decode('utf-8')
+
+
+def url_hash(url):
+    """SHA-1 hex digest of url_key(), stored on Page for indexed lookups."""
+    return hashlib.sha1(url_key(url).encode('utf-8')).hexdigest()
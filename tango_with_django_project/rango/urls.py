@@ -21,4 +21,5 @@ urlpatterns = patterns('',
                        url(r'like_category/$', views.like_category, name='like_category'),
                        url(r'^suggest_category/$', views.suggest_category, name='suggest_category'),
                        url(r'^auto_add_page/$', views.auto_add_page, name='auto_add_page'),
+                       url(r'^admission_metrics/$', views.admission_metrics, name='admission_metrics'),
 )
\ No newline at end of file
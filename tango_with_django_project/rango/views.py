@@ -6,12 +6,19 @@ from django.shortcuts import render_to_response
 from django.contrib.auth import authenticate, login, logout
 from django.http import HttpResponseRedirect, HttpResponse
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.urlresolvers import reverse
-from actstream import action
+from django.core.cache import cache
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
 
-from models import Category, Page, UserProfile
+from models import Category, Page, UserProfile, RelatedPage, CATEGORY_LIST_CACHE_KEY, TOP_PAGES_CACHE_KEY
 from forms import CategoryForm, PageForm, UserForm, UserProfileForm
-from bing_search import run_query
+from urlnorm import canonicalize
+from tasks import (defer_action, defer_prefetch_search, defer_click, search_results, process_profile_image,
+                   increment_counter, ref)
+from admission import metrics_json
 
 
 def index(request):
@@ -25,8 +32,8 @@ def index(request):
     # Place the List in our context_dict dictionary which will be passed to the template engine.
     category_list = get_category_list()
 
-    most_viewed_page_list = Page.objects.order_by('-views')[:5]
-    feed_list = Action.objects.order_by('-timestamp')[:5]
+    most_viewed_page_list = get_top_pages()
+    feed_list = Action.objects.order_by('-timestamp').fetch_generic_relations()[:5]
     context_dict = {'categories': category_list,
                     'mostViewedPages': most_viewed_page_list,
                     'feeds': feed_list,
@@ -61,7 +68,12 @@ def like_category(request):
         try:
             category = Category.objects.get(id=category_id)
             category.likes += 1
-            category.save()
+            # When the database is busy the admission control middleware
+            # asks for the increment to be queued instead.
+            if getattr(request, 'defer_writes', False):
+                increment_counter.delay(ref(category), 'likes')
+            else:
+                Category.objects.filter(id=category.id).update(likes=F('likes') + 1)
         except Category.DoesNotExist:
             pass
     else:
@@ -70,7 +82,28 @@ def like_category(request):
     return HttpResponse(category.likes)
 
 
+def get_top_pages():
+    pages = cache.get(TOP_PAGES_CACHE_KEY)
+    if pages is None:
+        pages = list(Page.objects.select_related('category').order_by('-views')[:5])
+        cache.set(TOP_PAGES_CACHE_KEY, pages, settings.TOP_PAGES_CACHE_TIMEOUT)
+    return pages
+
+
 def get_category_list(max_results=0, starts_with=''):
+    # The full list is shown on nearly every page, so keep it cached.
+    # It is invalidated whenever a category is saved or deleted.
+    if not (max_results or starts_with):
+        cat_list = cache.get(CATEGORY_LIST_CACHE_KEY)
+        if cat_list is None:
+            cat_list = list(query_category_list())
+            cache.set(CATEGORY_LIST_CACHE_KEY, cat_list, settings.CATEGORY_LIST_CACHE_TIMEOUT)
+        return cat_list
+
+    return query_category_list(max_results, starts_with)
+
+
+def query_category_list(max_results=0, starts_with=''):
     cat_list = []
     if starts_with:
         cat_list = Category.objects.filter(name__istartswith=starts_with).order_by('-likes')
@@ -111,6 +144,7 @@ def category(request, category_name_url):
         pages = Page.objects.filter(category=cat).order_by('-views')
         context_dict['pages'] = pages
         context_dict['category'] = cat
+        context_dict['related_pages'] = get_related_pages(cat)
     except Category.DoesNotExist:
         pass
 
@@ -119,14 +153,30 @@ def category(request, category_name_url):
             query = request.POST['query'].strip()
 
             if query:
-                result_list = run_query(query)
+                context_dict['query'] = query
+                result_list = search_results(query)
                 context_dict['result_list'] = result_list
+                context_dict['search_pending'] = result_list is None
         except Exception:
             pass
 
     return render_to_response('rango/category.html', context_dict, context)
 
 
+def get_related_pages(category, max_results=5):
+    # Pages in other categories that visitors of this category's pages
+    # also went to, best scores first. RelatedPage is precomputed nightly.
+    related_pages = []
+    related = RelatedPage.objects.filter(page__category=category).exclude(related__category=category) \
+        .select_related('related').order_by('-score')
+    for item in related[:max_results * settings.RELATED_PAGES]:
+        if item.related not in related_pages:
+            related_pages.append(item.related)
+            if len(related_pages) == max_results:
+                break
+    return related_pages
+
+
 def encode_url(category_name):
     return category_name.replace(' ', '_')
 
@@ -152,7 +202,8 @@ def add_category(request):
             # Now call the index() view.
             # The user will be shown the homepage.
 
-            action.send(request.user, verb='added', action_object=category)
+            defer_action(request.user, 'added', action_object=category)
+            defer_prefetch_search(category.name)
             return index(request)
         else:
             # The supplied form contained errors - just print them to the terminal.
@@ -179,7 +230,12 @@ def auto_add_page(request):
                 category = Category.objects.get(id=cat_id)
             except Category.DoesNotExist:
                 return HttpResponse("Category.DoesNotExist")
-            Page.objects.get_or_create(category=category, title=title, url=url)
+            try:
+                with transaction.atomic():
+                    Page.objects.create(category=category, title=title, url=canonicalize(url))
+            except IntegrityError:
+                # The page is already in this category.
+                pass
             pages = Page.objects.filter(category=category).order_by('-views')
 
     return render_to_response('rango/page_list.html', {'pages': pages}, context)
@@ -212,9 +268,19 @@ def add_page(request, category_name_url):
             # Also, create a default value for the number of views.
             page.views = 0
 
-            # With this, we can then save our new model instance.
-            page.save()
-            action.send(request.user, verb='added page', action_object=page, target=cat)
+            # With this, we can then save our new model instance. The unique
+            # (category, url_hash) constraint stops the same page being added
+            # to a category twice, even by concurrent requests.
+            try:
+                with transaction.atomic():
+                    page.save()
+            except IntegrityError:
+                form.errors['url'] = form.error_class(["That page is already in this category."])
+                return render_to_response('rango/add_page.html',
+                                          {'category_name_url': category_name_url,
+                                           'category_name': category_name, 'form': form},
+                                          context)
+            defer_action(request.user, 'added page', action_object=page, target=cat)
             # Now that the page is saved, display the category instead.
             return category(request, category_name_url)
         else:
@@ -264,9 +330,11 @@ def register(request):
                 profile.picture = request.FILES['picture']
 
             profile.save()
+            if profile.picture:
+                process_profile_image.delay(profile.id)
 
             registered = True
-            action.send(profile.user, verb='just registered')
+            defer_action(profile.user, 'just registered')
 
 
         else:
@@ -321,16 +389,19 @@ def user_logout(request):
 
 def search(request):
     context = RequestContext(request)
-    result_list = []
+    context_dict = {'result_list': []}
 
     if request.method == 'POST':
         query = request.POST['query'].strip()
 
         if query:
-            # Run our Bing function to get the results list!
-            result_list = run_query(query)
+            # A worker fetches the results from Bing; until then the search
+            # is shown as pending.
+            context_dict['query'] = query
+            context_dict['result_list'] = search_results(query)
+            context_dict['search_pending'] = context_dict['result_list'] is None
 
-    return render_to_response('rango/search.html', {'result_list': result_list}, context)
+    return render_to_response('rango/search.html', context_dict, context)
 
 
 @login_required
@@ -354,8 +425,18 @@ def track_url(request):
             page = Page.objects.get(id=page_id)
         except Page.DoesNotExist:
             return HttpResponseRedirect(reverse('rango:index'))
-        page.views += 1
-        page.save()
+        if request.session.session_key:
+            defer_click(request.session.session_key, page.id)
+
+        if getattr(request, 'defer_writes', False):
+            increment_counter.delay(ref(page), 'views')
+        else:
+            Page.objects.filter(id=page.id).update(views=F('views') + 1)
         return HttpResponseRedirect(page.url)
 
-    return HttpResponseRedirect(reverse('rango:index'))
\ No newline at end of file
+    return HttpResponseRedirect(reverse('rango:index'))
+
+
+@staff_member_required
+def admission_metrics(request):
+    return HttpResponse(metrics_json(), content_type='application/json')
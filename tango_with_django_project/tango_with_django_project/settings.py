@@ -18,6 +18,11 @@ TEMPLATE_DIRS = (
     TEMPLATE_PATH,
 )
 
+TEMPLATE_LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+)
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.6/howto/deployment/checklist/
@@ -30,6 +35,18 @@ DEBUG = True
 
 TEMPLATE_DEBUG = True
 
+# Keep compiled templates in memory outside of development, so the warm
+# start in wsgi.py can compile them once before the workers fork.
+if not DEBUG:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
+
+# Preload urls, templates and caches when the WSGI application is imported.
+# Off in development, where runserver imports it again on every reload and
+# templates are not kept compiled anyway; set it to True to try it there.
+WARM_START = not DEBUG
+
 ALLOWED_HOSTS = []
 
 
@@ -52,6 +69,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'rango.admission.AdmissionControlMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -72,6 +90,66 @@ ACTSTREAM_SETTINGS = {
 }
 
 
+# Admission control for views that write to the database (see rango/admission.py)
+# ROUTES maps url names to what happens when a request is not admitted
+# ('shed' answers 503, 'defer' queues the view's counter update) and the
+# methods that write.
+
+ADMISSION_CONTROL = {
+    'ROUTES': {
+        'track_url': ('defer', ('GET',)),
+        'like_category': ('defer', ('GET',)),
+        'auto_add_page': ('shed', ('GET',)),
+        'add_category': ('shed', ('POST',)),
+        'add_page': ('shed', ('POST',)),
+        'register': ('shed', ('POST',)),
+    },
+    'STATE_PATH': '/dev/shm/rango-admission' if os.path.isdir('/dev/shm') else os.path.join(BASE_DIR, 'admission'),
+    'MAX_WRITERS': 4,
+    'MAX_QUEUE': 32,
+    'MAX_WAIT': 2.0,
+    'POLL_INTERVAL': 0.01,
+    # Seconds after which a writer slot that was never released is reclaimed.
+    'MAX_HOLD': 60.0,
+    # Tokens per second and bucket size, per client and per route.
+    'CLIENT_RATE': 2.0,
+    'CLIENT_BURST': 10,
+    'ROUTE_RATE': 100.0,
+    'ROUTE_BURST': 200,
+    'BUCKETS': 4096,
+}
+
+
+# Recommendations
+# Clicks are stored in batches of CLICK_BATCH_SIZE, or every
+# CLICK_FLUSH_INTERVAL seconds, and turned into related pages nightly. A day
+# is only folded CLICK_FOLD_DELAY seconds after it has ended, so that its
+# late clicks are not split off into a basket of their own.
+
+CLICK_BATCH_SIZE = 50
+CLICK_FLUSH_INTERVAL = 60
+CLICK_FOLD_DELAY = 2 * 60 * 60
+
+# Related pages kept per page, and the fewest sessions a pair needs to count.
+RELATED_PAGES = 5
+RELATED_PAGES_MIN_SESSIONS = 2
+
+
+# Activity retention
+# Days to keep actions of each verb before archiving them (None keeps them
+# forever). 'default' covers every other verb.
+
+ACTION_RETENTION_DAYS = {
+    'default': 180,
+    'just registered': 365,
+}
+
+ACTION_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# Seconds between runs of the archive and ANALYZE/incremental vacuum task.
+DB_MAINTENANCE_INTERVAL = 24 * 60 * 60
+
+
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
@@ -84,6 +162,49 @@ DATABASES = {
     }
 }
 
+# Cache
+# Shared between the web and task worker processes, so it must not be per-process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+SEARCH_CACHE_TIMEOUT = 60 * 60
+CATEGORY_LIST_CACHE_TIMEOUT = 60 * 60
+TOP_PAGES_CACHE_TIMEOUT = 60
+
+
+# Background tasks
+# Run the workers with: python manage.py run_tasks --workers 2
+
+TASK_QUEUE_PATH = os.path.join(BASE_DIR, 'tasks.db')
+
+# Run tasks immediately inside .delay() instead of queueing them (for tests).
+TASK_ALWAYS_EAGER = False
+
+# Seconds before the first retry of a failed task; doubled on each attempt.
+TASK_RETRY_BACKOFF = 10
+
+# Seconds after which a running task whose worker has stopped refreshing its
+# lock is assumed to belong to a dead worker.
+TASK_LOCK_TIMEOUT = 600
+
+# Done and failed tasks are deleted by the scheduled maintenance after this
+# many seconds.
+TASK_PURGE_AFTER = 7 * 24 * 60 * 60
+
+PROFILE_IMAGE_SIZE = (300, 300)
+
+
+# Admin
+# Unfiltered changelists of tables at least this big show an estimated count.
+
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
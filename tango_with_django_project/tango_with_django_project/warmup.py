@@ -0,0 +1,159 @@
+"""
+Warm start for WSGI workers.
+
+warm_up() does the work the first requests to a fresh worker would
+otherwise pay for: loading the URLconf (and with it admin.autodiscover()
+and the actstream registry), compiling templates, opening the database and
+filling the category and leaderboard caches where they are empty. wsgi.py calls it at import
+time, so a prefork server that loads the application before forking
+(e.g. gunicorn --preload) does it once and shares the result with every
+worker copy-on-write.
+
+Django is imported inside the functions so that profile_imports() can time
+those imports as well. Its child process warms a cache of its own, so
+profiling leaves the site's cache alone.
+"""
+
+import gc
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    """Preload the project and return a list of (step, seconds) timings.
+
+    A step that fails is logged and listed as failed, and the others still
+    run: warming up only saves time.
+    """
+    timings = []
+
+    def step(name, func):
+        start = time.time()
+        try:
+            func()
+        except Exception:
+            logger.exception('Warm start step %s failed.', name)
+            name += ' (failed)'
+        timings.append((name, time.time() - start))
+
+    step('urls', resolve_urls)
+    step('templates', compile_templates)
+    step('caches', prime_caches)
+    step('fork prep', prepare_for_fork)
+    return timings
+
+
+def resolve_urls():
+    from django.core.urlresolvers import get_resolver, reverse, resolve, NoReverseMatch
+    from rango import urls
+
+    # Building the reverse dictionaries imports every URLconf.
+    get_resolver(None).reverse_dict
+
+    for pattern in urls.urlpatterns:
+        if not pattern.name:
+            continue
+        kwargs = dict((group, 'warmup') for group in pattern.regex.groupindex)
+        try:
+            resolve(reverse('rango:' + pattern.name, kwargs=kwargs))
+        except NoReverseMatch:
+            pass
+
+
+def compile_templates():
+    from django.conf import settings
+    from django.template.loader import get_template
+
+    for template_dir in settings.TEMPLATE_DIRS:
+        for root, dirs, files in os.walk(template_dir):
+            for filename in files:
+                if filename.endswith('.html'):
+                    get_template(os.path.relpath(os.path.join(root, filename), template_dir))
+
+
+def prime_caches():
+    from rango.views import get_category_list, get_top_pages
+
+    # Entries other workers are serving stay; they expire or are invalidated
+    # on their own.
+    get_category_list()
+    get_top_pages()
+
+
+def prepare_for_fork():
+    from django.db import connections
+
+    # Each worker must open its own database connection after the fork.
+    for connection in connections.all():
+        connection.close()
+
+    # Collect now so the garbage collector does not touch (and so copy) the
+    # shared pages in every worker soon after it starts.
+    gc.collect()
+
+
+class ImportTimer(object):
+    """Wraps __import__ and records how long each newly loaded module took."""
+
+    def __init__(self):
+        self.timings = {}
+        self.stack = []
+
+    def install(self):
+        import __builtin__
+        self.original_import = __builtin__.__import__
+        __builtin__.__import__ = self
+
+    def uninstall(self):
+        import __builtin__
+        __builtin__.__import__ = self.original_import
+
+    def __call__(self, name, *args, **kwargs):
+        loaded = len(sys.modules)
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            if len(sys.modules) > loaded and name not in self.timings:
+                self.timings[name] = (elapsed, elapsed - nested)
+
+
+def _profile_child():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tango_with_django_project.settings')
+    timer = ImportTimer()
+    timer.install()
+    start = time.time()
+    from django.conf import settings
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    from django.core.wsgi import get_wsgi_application
+    get_wsgi_application()
+    __import__(settings.ROOT_URLCONF)
+    import_time = time.time() - start
+    timer.uninstall()
+
+    json.dump({'imports': timer.timings, 'import_time': import_time, 'warm_up': warm_up()}, sys.stdout)
+
+
+def profile_imports():
+    """Load the project in a fresh interpreter and report where the time goes.
+
+    Returns a dict with per-module 'imports' timings as
+    {module: (cumulative, self)}, the total 'import_time' and the
+    'warm_up' step timings.
+    """
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'from tango_with_django_project.warmup import _profile_child; _profile_child()'],
+        cwd=base_dir)
+    return json.loads(output)
@@ -11,6 +11,15 @@ import os
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tango_with_django_project.settings")
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 application = get_wsgi_application()
+
+# Load everything the first requests would otherwise wait for. Run a
+# prefork server with the application preloaded (gunicorn --preload) so
+# this happens once in the master and is shared by the workers.
+if settings.WARM_START:
+    # Steps that fail are logged and the workers start that much colder.
+    from tango_with_django_project.warmup import warm_up
+    warm_up()